@@ -34,10 +34,23 @@ import pytz
 from decimal import Decimal
 import configparser
 import logging
+from logging.handlers import MemoryHandler
+import atexit
+import os
+import shutil
+import tempfile
+
+# amounts come to us as integer pence, shift them to pounds without a division
+def pence_to_decimal(pence):
+    return Decimal(pence).scaleb(-2)
+
+# resolve the timezones once rather than per transaction
+UTC = pytz.utc
+LONDON_TZ = pytz.timezone("Europe/London")
 
 # setup initial Logging
-logging.getLogger().setLevel(logging.NOTSET)
 logger = logging.getLogger('Stripe import')
+logger.setLevel(logging.INFO)
 _ch = logging.StreamHandler()
 _ch.setLevel(logging.INFO)    # this should be WARN by default
 _formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -46,148 +59,176 @@ logger.addHandler(_ch)
 _fh = logging.FileHandler('stripe-import.log')
 _fh.setFormatter(_formatter)
 _fh.setLevel(logging.INFO)
-logger.addHandler(_fh)
+# buffer file writes, flushing in batches, on anything at WARNING or above, and at exit
+_mh = MemoryHandler(capacity=1024, flushLevel=logging.WARNING, target=_fh)
+_mh.setLevel(logging.INFO)
+logger.addHandler(_mh)
+atexit.register(_mh.close)
 
 logger.info("Importing Stripe charges")
 configFilename = 'imports.cfg'
 config = configparser.ConfigParser()
 config.read(configFilename)
 
+# write the config to a temp file and swap it into place, so a crash or power cut part way through can't leave it truncated
+def save_config():
+    fd, tempFilename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(configFilename)))
+    try:
+        with os.fdopen(fd, 'w') as configfile:
+            config.write(configfile)
+            configfile.flush()
+            os.fsync(configfile.fileno())
+        shutil.copymode(configFilename, tempFilename)
+        os.replace(tempFilename, configFilename)
+    except BaseException:
+        # don't leave a copy of our secrets lying next to the config
+        os.unlink(tempFilename)
+        raise
+
 # load stripe api key from config
 stripe.api_key = config['Stripe']['api_key']
 
 # gnucash book we are working with
 bookPath = config['GNUCash']['book_path']
-logger.info("Into GnuCash book: {}".format(bookPath))
+logger.info("Into GnuCash book: %s", bookPath)
 
 # work out how far back we need to go
 lastRunDate = datetime.strptime(config['Stripe']['last_run'], '%Y-%m-%dT%H:%M:%S.%f')
-logger.info('Last Run: ' + str(lastRunDate))
+logger.info('Last Run: %s', lastRunDate)
 # go back 24 hours from our last run to make sure we don't miss anything
 fetchTimestamp = int((lastRunDate - timedelta(days=1)).timestamp())
 
-stripeTransactions = stripe.BalanceTransaction.list(limit=1000, created={'gt': fetchTimestamp}, expand=['data.source'])
-logger.info("Fetched {} transactions from Stripe".format(len(stripeTransactions)))
+# stripe caps a page at 100, so let the auto pager walk every page for us
+stripeTransactions = list(stripe.BalanceTransaction.list(limit=100, created={'gt': fetchTimestamp}, expand=['data.source']).auto_paging_iter())
+# stripe lists newest first, we want to record them oldest first
+stripeTransactions.reverse()
+logger.info("Fetched %s transactions from Stripe", len(stripeTransactions))
 
 if (len(stripeTransactions) == 0):
     logger.info("No transactions to import")
     exit()
 
 with open_book(bookPath, readonly=False) as book:
+    # index every account by its full name once, so lookups are a dict hit rather than a tree walk
+    accountsByName = {account.fullname: account for account in book.accounts}
     # grab the accounts we need
-    stripeAccount = book.accounts(fullname="Assets:Current Assets:Stripe")
-    feeExpenseAccount = book.accounts(fullname="Expenses:Bank Service Charge")
-    miscellaneousExpenseAccount = book.accounts(fullname="Expenses:Miscellaneous")
-    snackspaceIncomeAccount = book.accounts(fullname="Income:Snackspace")
-    donationsIncomeAccount = book.accounts(fullname="Income:Donations")
+    stripeAccount = accountsByName["Assets:Current Assets:Stripe"]
+    feeExpenseAccount = accountsByName["Expenses:Bank Service Charge"]
+    miscellaneousExpenseAccount = accountsByName["Expenses:Miscellaneous"]
+    snackspaceIncomeAccount = accountsByName["Income:Snackspace"]
+    donationsIncomeAccount = accountsByName["Income:Donations"]
     gbp = stripeAccount.commodity
 
-    for stripeTransaction in reversed(stripeTransactions.to_dict()['data']):
-        try:
-            # see if we have already recorded this transaction
-            book.transactions.get(num=stripeTransaction.id)
-            logger.info("Skipped already recorded: {}".format(stripeTransaction.id ))
+    # load every num we have already recorded up front rather than querying the book per transaction
+    existingNums = {num for (num,) in book.session.query(Transaction.num)}
+
+    # record a transaction in the book and remember its num
+    def make_txn(num, createdAt, description, splits):
+        Transaction(currency=gbp,
+                    enter_date=createdAt,
+                    post_date=createdAt.date(),
+                    num=num,
+                    description=description,
+                    splits=splits)
+        existingNums.add(num)
+
+    # charges fetched for adjustments, so several adjustments against one charge only fetch it once
+    chargeCache = {}
+
+    for stripeTransaction in stripeTransactions:
+        # see if we have already recorded this transaction
+        if stripeTransaction.id in existingNums:
+            logger.info("Skipped already recorded: %s", stripeTransaction.id)
             continue
-        except KeyError:
-            # we have not yet recorded this txn_ id
-            pass
 
         # pull out some generic details for this transaction
-        amount = Decimal(-1 * stripeTransaction.amount)/100
-        fee = Decimal(stripeTransaction.fee)/100
-        net = Decimal(stripeTransaction.net)/100
-        createdAt = pytz.utc.localize(datetime.fromtimestamp(stripeTransaction.created)).astimezone(pytz.timezone("Europe/London"))
+        amount = pence_to_decimal(-stripeTransaction.amount)
+        fee = pence_to_decimal(stripeTransaction.fee)
+        net = pence_to_decimal(stripeTransaction.net)
+        createdAt = datetime.fromtimestamp(stripeTransaction.created, tz=UTC).astimezone(LONDON_TZ)
 
         if stripeTransaction.type == 'charge':
+            # pull the bits of the charge we need out once
+            source = stripeTransaction.source
+            metadata = source.metadata
+            statementDescriptor = getattr(source, 'statement_descriptor', None)
+            statementDescriptorSuffix = getattr(source, 'statement_descriptor_suffix', None)
+            billingName = source.billing_details.get('name')
+
             # build description for gnu cash
-            description = "Stripe "
-            if stripeTransaction.source.statement_descriptor is not None:
-                description += stripeTransaction.source.statement_descriptor + ": "
-            elif stripeTransaction.source.statement_descriptor_suffix is not None:
-                description += stripeTransaction.source.statement_descriptor_suffix + ": "
-            if 'user_id' in stripeTransaction.source.metadata:
-                description += stripeTransaction.source.metadata.user_id + ", "
-            if 'name' in stripeTransaction.source.billing_details:
-                if stripeTransaction.source.billing_details.name is not None:
-                    description += stripeTransaction.source.billing_details.name
-            description += " (" + stripeTransaction.source.payment_method_details.card.last4 + ")"
+            descriptionParts = ["Stripe "]
+            if statementDescriptor is not None:
+                descriptionParts.append(statementDescriptor + ": ")
+            elif statementDescriptorSuffix is not None:
+                descriptionParts.append(statementDescriptorSuffix + ": ")
+            if 'user_id' in metadata:
+                descriptionParts.append(metadata.user_id + ", ")
+            if billingName is not None:
+                descriptionParts.append(billingName)
+            descriptionParts.append(" (" + source.payment_method_details.card.last4 + ")")
+            description = "".join(descriptionParts)
 
             # which account are we assigning this to
             toAccount = donationsIncomeAccount
-            if 'type' in stripeTransaction.source.metadata:
-                if stripeTransaction.source.metadata.type.upper() == 'SNACKSPACE':
+            if 'type' in metadata:
+                if metadata.type.upper() == 'SNACKSPACE':
                     toAccount = snackspaceIncomeAccount
-            elif stripeTransaction.source.statement_descriptor == 'Snackspace':
-                toAccount = snackspaceIncomeAccount
-            elif stripeTransaction.source.statement_descriptor_suffix == 'Snackspace':
+            elif 'Snackspace' in (statementDescriptor, statementDescriptorSuffix):
                 toAccount = snackspaceIncomeAccount
 
-            Transaction(currency=gbp,
-                        enter_date=createdAt,
-                        post_date=createdAt.date(),
-                        num=stripeTransaction.id,
-                        description=description,
-                        splits=[
-                            Split(account=stripeAccount, value=net),
-                            Split(account=toAccount, value=amount),
-                            Split(account=feeExpenseAccount, value=fee)
-                        ])
-
-            logger.info("Saved charge: {}, {}, {}".format(stripeTransaction.id, createdAt.date(), description))
+            make_txn(stripeTransaction.id, createdAt, description, [
+                Split(account=stripeAccount, value=net),
+                Split(account=toAccount, value=amount),
+                Split(account=feeExpenseAccount, value=fee)
+            ])
+
+            logger.info("Saved charge: %s, %s, %s", stripeTransaction.id, createdAt.date(), description)
         elif stripeTransaction.type == 'adjustment':
             description = "Stripe: " + stripeTransaction.description
             if net < 0:
                 toAccount = miscellaneousExpenseAccount
             else:
-                stripeCharge = stripe.Charge.retrieve(stripeTransaction.source.charge)
+                chargeId = stripeTransaction.source.charge
+                if chargeId not in chargeCache:
+                    chargeCache[chargeId] = stripe.Charge.retrieve(chargeId)
+                stripeCharge = chargeCache[chargeId]
 
                 toAccount = donationsIncomeAccount
                 if 'type' in stripeCharge.metadata:
                     if stripeCharge.metadata.type.upper() == 'SNACKSPACE':
                         toAccount = snackspaceIncomeAccount
 
-            Transaction(currency=gbp,
-                        enter_date=createdAt,
-                        post_date=createdAt.date(),
-                        num=stripeTransaction.id,
-                        description=description,
-                        splits=[
-                            Split(account=stripeAccount, value=net),
-                            Split(account=toAccount, value=amount),
-                            Split(account=feeExpenseAccount, value=fee)
-                        ])
-
-            logger.info("Saved adjustment: {}, {}, {}".format(stripeTransaction.id, createdAt.date(), stripeTransaction.description))
+            make_txn(stripeTransaction.id, createdAt, description, [
+                Split(account=stripeAccount, value=net),
+                Split(account=toAccount, value=amount),
+                Split(account=feeExpenseAccount, value=fee)
+            ])
+
+            logger.info("Saved adjustment: %s, %s, %s", stripeTransaction.id, createdAt.date(), stripeTransaction.description)
         elif stripeTransaction.type == 'refund':
             description = "Stripe: " + stripeTransaction.description + ": " + stripeTransaction.source.charge
 
             toAccount = miscellaneousExpenseAccount
 
-            Transaction(currency=gbp,
-                        enter_date=createdAt,
-                        post_date=createdAt.date(),
-                        num=stripeTransaction.id,
-                        description=stripeTransaction.description,
-                        splits=[
-                            Split(account=stripeAccount, value=net),
-                            Split(account=toAccount, value=amount),
-                        ])
-
-            logger.info("Saved refund: {}, {}, {}".format(stripeTransaction.id, createdAt.date(), description))
+            make_txn(stripeTransaction.id, createdAt, stripeTransaction.description, [
+                Split(account=stripeAccount, value=net),
+                Split(account=toAccount, value=amount),
+            ])
+
+            logger.info("Saved refund: %s, %s, %s", stripeTransaction.id, createdAt.date(), description)
         elif stripeTransaction.type == 'payout':
             # payouts will be recorded when they show up in our TSB CSV
-            logger.info("Skipped Payout: {}, {}, £{}".format(stripeTransaction.id, createdAt.date(), amount))
+            logger.info("Skipped Payout: %s, %s, £%s", stripeTransaction.id, createdAt.date(), amount)
         else:
             # don't know what type this is
-            logger.info("Skipped Unknown type: {}, {}, {}".format(stripeTransaction.type, stripeTransaction.id, createdAt.date()))
+            logger.info("Skipped Unknown type: %s, %s, %s", stripeTransaction.type, stripeTransaction.id, createdAt.date())
 
     # save the book
     if not book.is_saved:
         book.save()
 
-    # update last run date
-    config['Stripe']['last_run'] = datetime.now().isoformat()
+# update last run date, now the book has been closed
+config['Stripe']['last_run'] = datetime.now().isoformat()
 
-    # and save it to the config
-    with open(configFilename, 'w') as configfile:
-        config.write(configfile)
+# and save it to the config
+save_config()
@@ -29,15 +29,28 @@
 """
 from piecash import open_book, Transaction, Split, GncImbalanceError, ledger
 from requests_oauthlib import OAuth2Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import pytz
 from decimal import Decimal
 import configparser
 import logging
+from logging.handlers import MemoryHandler
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# resolve the timezone once rather than per transaction
+LONDON_TZ = pytz.timezone("Europe/London")
 
 # setup initial Logging
-logging.getLogger().setLevel(logging.NOTSET)
 logger = logging.getLogger('SumUp import')
+logger.setLevel(logging.INFO)
 _ch = logging.StreamHandler()
 _ch.setLevel(logging.INFO)    # this should be WARN by default
 _formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -46,19 +59,40 @@ logger.addHandler(_ch)
 _fh = logging.FileHandler('sumup-import.log')
 _fh.setFormatter(_formatter)
 _fh.setLevel(logging.INFO)
-logger.addHandler(_fh)
+# buffer file writes, flushing in batches, on anything at WARNING or above, and at exit
+_mh = MemoryHandler(capacity=1024, flushLevel=logging.WARNING, target=_fh)
+_mh.setLevel(logging.INFO)
+logger.addHandler(_mh)
+atexit.register(_mh.close)
 
 logger.info("Importing SumUp charges")
 configFilename = 'imports.cfg'
 config = configparser.ConfigParser()
 config.read(configFilename)
 
+# write the config to a temp file and swap it into place, so a crash or power cut part way through can't leave it truncated
+def save_config():
+    fd, tempFilename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(configFilename)))
+    try:
+        with os.fdopen(fd, 'w') as configfile:
+            config.write(configfile)
+            configfile.flush()
+            os.fsync(configfile.fileno())
+        shutil.copymode(configFilename, tempFilename)
+        os.replace(tempFilename, configFilename)
+    except BaseException:
+        # don't leave a copy of our secrets lying next to the config
+        os.unlink(tempFilename)
+        raise
+
 # sumup api keys
 client_id = config['SumUp']['client_id']
 client_secret = config['SumUp']['client_secret']
 authorization_base_url = 'https://api.sumup.com/authorize'
 token_url = 'https://api.sumup.com/token'
 refresh_url = 'https://api.sumup.com/token'
+# seconds of life a token must have left before we fan out the detail fetches
+tokenRefreshMargin = 300
 token = {
     'access_token': config['SumUp']['access_token'],
     'refresh_token': config['SumUp']['refresh_token'],
@@ -70,29 +104,43 @@ extra = {
     'client_secret': client_secret,
 }
 # After updating the token you will most likely want to save it.
+# the lock stops two refreshes from interleaving their writes to the config
+tokenLock = threading.Lock()
 def token_saver(token):
-    logger.info("Saving new token")
-    # update config with new token
-    config['SumUp']['access_token'] = token['access_token']
-    config['SumUp']['refresh_token'] = token['refresh_token']
-    config['SumUp']['expires_at'] = str(token['expires_at'])
-    # and save it to the config
-    with open(configFilename, 'w') as configfile:
-        config.write(configfile)
+    with tokenLock:
+        logger.info("Saving new token")
+        # update config with new token
+        config['SumUp']['access_token'] = token['access_token']
+        config['SumUp']['refresh_token'] = token['refresh_token']
+        config['SumUp']['expires_at'] = str(token['expires_at'])
+        # and save it to the config
+        save_config()
 
 # gnucash book we are working with
 bookPath = config['GNUCash']['book_path']
-logger.info("Into GnuCash book: {}".format(bookPath))
+logger.info("Into GnuCash book: %s", bookPath)
 
 # work out how far back we need to go
 lastRunDate = datetime.strptime(config['SumUp']['last_run'], '%Y-%m-%dT%H:%M:%S.%f')
-logger.info('Last Run: ' + str(lastRunDate))
+logger.info('Last Run: %s', lastRunDate)
 # go back 24 hours from our last run to make sure we don't miss anything
 oldestTime = (lastRunDate - timedelta(days=1)).isoformat()
 
 # setup request client
 client = OAuth2Session(client_id, token=token, auto_refresh_url=refresh_url,
     auto_refresh_kwargs=extra, token_updater=token_saver)
+# pool connections so the per transaction fetches reuse the same TLS session, and retry transient failures
+retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+client.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries))
+
+# fetch the full transaction from sumup
+def fetch_transaction(transactionId):
+    data = {
+        'id': transactionId
+    }
+    r = client.get('https://api.sumup.com/v0.1/me/transactions', data=data)
+    return r.json(parse_float=Decimal)
+
 # fetch
 data = {
     'order': 'descending',
@@ -101,54 +149,73 @@ data = {
 }
 r = client.get('https://api.sumup.com/v0.1/me/transactions/history', data=data)
 sumUpTransactions = r.json(parse_float=Decimal)
-logger.info("Fetched {} transactions from SumUp".format(len(sumUpTransactions['items'])))
+logger.info("Fetched %s transactions from SumUp", len(sumUpTransactions['items']))
 
 if (len(sumUpTransactions['items']) == 0):
     logger.info("No transactions to import")
     exit()
 
 with open_book(bookPath, readonly=False) as book:
+    # index every account by its full name once, so lookups are a dict hit rather than a tree walk
+    accountsByName = {account.fullname: account for account in book.accounts}
     # grab the accounts we need
-    sumUpAccount = book.accounts(fullname="Assets:Current Assets:SumUp")
-    feeExpenseAccount = book.accounts(fullname="Expenses:Bank Service Charge")
-    miscellaneousExpenseAccount = book.accounts(fullname="Expenses:Miscellaneous")
-    snackspaceIncomeAccount = book.accounts(fullname="Income:Snackspace")
-    donationsIncomeAccount = book.accounts(fullname="Income:Donations")
+    sumUpAccount = accountsByName["Assets:Current Assets:SumUp"]
+    feeExpenseAccount = accountsByName["Expenses:Bank Service Charge"]
+    miscellaneousExpenseAccount = accountsByName["Expenses:Miscellaneous"]
+    snackspaceIncomeAccount = accountsByName["Income:Snackspace"]
+    donationsIncomeAccount = accountsByName["Income:Donations"]
     gbp = sumUpAccount.commodity
 
+    # load every num we have already recorded up front rather than querying the book per transaction
+    existingNums = {num for (num,) in book.session.query(Transaction.num)}
+
+    # record a transaction in the book and remember its num
+    def make_txn(num, createdAt, description, splits):
+        Transaction(currency=gbp,
+                    enter_date=createdAt,
+                    post_date=createdAt.date(),
+                    num=num,
+                    description=description,
+                    splits=splits)
+        existingNums.add(num)
+
+    # work out which transactions still need importing
+    toImport = []
     for sumUpTransaction in sumUpTransactions['items']:
         if sumUpTransaction['status'] != 'SUCCESSFUL':
-            logger.info("Skipped Failed: {}".format(sumUpTransaction['id']))
+            logger.info("Skipped Failed: %s", sumUpTransaction['id'])
             continue
 
-        try:
-            # see if we have already recorded this transaction
-            book.transactions.get(num=sumUpTransaction['id'])
-            logger.info("Skipped already recorded: {}".format(sumUpTransaction['id'] ))
+        # see if we have already recorded this transaction
+        if sumUpTransaction['id'] in existingNums:
+            logger.info("Skipped already recorded: %s", sumUpTransaction['id'])
             continue
-        except KeyError:
-            # we have not yet recorded this txn_ id
-            pass
 
-        # fetch the full transaction from sumup
-        data = {
-            'id': sumUpTransaction['id']
-        }
+        toImport.append(sumUpTransaction)
+        # remember it so a repeated id later in this batch is skipped too
+        existingNums.add(sumUpTransaction['id'])
+
+    # the detail fetches are independent so run them in parallel, the book is only ever touched from this thread
+    # OAuth2Session only refreshes once the token has already expired, so refresh it here if it could expire
+    # while the workers run, rather than let several of them refresh with the same refresh token at once
+    if toImport and client.token.get('expires_at', 0) - time.time() < tokenRefreshMargin:
+        token_saver(client.refresh_token(refresh_url))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        transactions = list(executor.map(fetch_transaction, [sumUpTransaction['id'] for sumUpTransaction in toImport]))
 
-        r = client.get('https://api.sumup.com/v0.1/me/transactions', data=data)
-        transaction = r.json(parse_float=Decimal)
+    for sumUpTransaction, transaction in zip(toImport, transactions):
         if (len(transaction['events']) == 0):
-            logger.warn("Skipped no events for: {}".format(sumUpTransaction['id']))
+            logger.warning("Skipped no events for: %s", sumUpTransaction['id'])
             continue
         elif (len(transaction['events']) > 1):
-            logger.warn("Skipped more than one event for: {}".format(sumUpTransaction['id']))
+            logger.warning("Skipped more than one event for: %s", sumUpTransaction['id'])
             continue
 
         # pull out some generic details for this transaction
         amount = -1 * sumUpTransaction['amount']
         fee = transaction['events'][0]['fee_amount']
         net = transaction['events'][0]['amount']
-        createdAt = pytz.utc.localize(datetime.strptime(sumUpTransaction['timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ')).astimezone(pytz.timezone("Europe/London"))
+        createdAt = datetime.fromisoformat(sumUpTransaction['timestamp']).astimezone(LONDON_TZ)
 
         if sumUpTransaction['type'] == 'PAYMENT':
             # build description for gnu cash
@@ -157,18 +224,13 @@ with open_book(bookPath, readonly=False) as book:
             # which account are we assigning this to
             toAccount = snackspaceIncomeAccount
 
-            Transaction(currency=gbp,
-                        enter_date=createdAt,
-                        post_date=createdAt.date(),
-                        num=sumUpTransaction['id'],
-                        description=description,
-                        splits=[
-                            Split(account=sumUpAccount, value=net),
-                            Split(account=toAccount, value=amount),
-                            Split(account=feeExpenseAccount, value=fee)
-                        ])
-
-            logger.info("Saved charge: {}, {}, {}".format(sumUpTransaction['id'], createdAt.date(), description))
+            make_txn(sumUpTransaction['id'], createdAt, description, [
+                Split(account=sumUpAccount, value=net),
+                Split(account=toAccount, value=amount),
+                Split(account=feeExpenseAccount, value=fee)
+            ])
+
+            logger.info("Saved charge: %s, %s, %s", sumUpTransaction['id'], createdAt.date(), description)
         elif sumUpTransaction['type'] == 'CHARGE_BACK':
             description = "SumUp: {}".format(sumUpTransaction['transaction_code'])
             if net < 0:
@@ -176,45 +238,34 @@ with open_book(bookPath, readonly=False) as book:
             else:
                 toAccount = snackspaceIncomeAccount
 
-            Transaction(currency=gbp,
-                        enter_date=createdAt,
-                        post_date=createdAt.date(),
-                        num=sumUpTransaction['id'],
-                        description=description,
-                        splits=[
-                            Split(account=sumUpAccount, value=net),
-                            Split(account=toAccount, value=amount),
-                            Split(account=feeExpenseAccount, value=fee)
-                        ])
-
-            logger.info("Saved charge back: {}, {}, {}".foramt(sumUpTransaction['id'], createdAt.date(), sumUpTransaction['transaction_code']))
+            make_txn(sumUpTransaction['id'], createdAt, description, [
+                Split(account=sumUpAccount, value=net),
+                Split(account=toAccount, value=amount),
+                Split(account=feeExpenseAccount, value=fee)
+            ])
+
+            logger.info("Saved charge back: %s, %s, %s", sumUpTransaction['id'], createdAt.date(), sumUpTransaction['transaction_code'])
         elif sumUpTransaction['type'] == 'REFUND':
             description = "SumUp: {}, {}".format(sumUpTransaction['transaction_code'], sumUpTransaction['transaction_id'])
 
             toAccount = miscellaneousExpenseAccount
 
-            Transaction(currency=gbp,
-                        enter_date=createdAt,
-                        post_date=createdAt.date(),
-                        num=sumUpTransaction['id'],
-                        description=sumUpTransaction['transaction_code'],
-                        splits=[
-                            Split(account=sumUpAccount, value=net),
-                            Split(account=toAccount, value=amount),
-                        ])
-
-            logger.info("Saved refund: {}, {}, {}".format(sumUpTransaction['id'], createdAt.date(), description))
+            make_txn(sumUpTransaction['id'], createdAt, sumUpTransaction['transaction_code'], [
+                Split(account=sumUpAccount, value=net),
+                Split(account=toAccount, value=amount),
+            ])
+
+            logger.info("Saved refund: %s, %s, %s", sumUpTransaction['id'], createdAt.date(), description)
         else:
             # don't know what type this is
-            logger.info("Skipped Unknown type: {}, {}, {}".format(sumUpTransaction['type'], sumUpTransaction['id'], createdAt.date()))
+            logger.info("Skipped Unknown type: %s, %s, %s", sumUpTransaction['type'], sumUpTransaction['id'], createdAt.date())
 
     # save the book
     if not book.is_saved:
         book.save()
 
-    # update last run date
-    config['SumUp']['last_run'] = datetime.now().isoformat()
+# update last run date, now the book has been closed
+config['SumUp']['last_run'] = datetime.now().isoformat()
 
-    # and save it to the config
-    with open(configFilename, 'w') as configfile:
-        config.write(configfile)
+# and save it to the config
+save_config()
@@ -35,17 +35,46 @@ from dateutil.parser import isoparse
 import pytz
 from decimal import Decimal
 import configparser
+import argparse
 import logging
+from logging.handlers import MemoryHandler
+import atexit
 import os
 import sys
 import json
 import hashlib
 
+# amounts come to us as integer pence, keep them as ints and only shift them to pounds when building the splits
+def pence_to_decimal(pence):
+    return Decimal(pence).scaleb(-2)
+
+# resolve the timezone once rather than per transaction
+LONDON_TZ = pytz.timezone("Europe/London")
+
+# orjson is optional, but when installed it is much quicker at the per line parsing
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+# parse a stdin line and build the hash for it to use a an UID
+# this has to stay sha256, every TSB transaction already in the book is keyed by it
+# and the scrape overlaps previous runs so a new scheme would re-import them
+def prepare_line(line):
+    transaction = json_loads(line)
+    hashString = f"{transaction['date']}:{transaction['description']};{transaction['amount']}"
+    return line, transaction, hashString, hashlib.sha256(hashString.encode()).hexdigest()
+
 dirname = os.path.dirname(os.path.realpath(__file__))
 
 # setup initial Logging
-logging.getLogger().setLevel(logging.NOTSET)
 logger = logging.getLogger('TSB import')
+logger.setLevel(logging.INFO)
 # _ch = logging.StreamHandler()
 # _ch.setLevel(logging.WARN)    # this should be WARN by default
 _formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -54,9 +83,18 @@ _formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messa
 _fh = logging.FileHandler(os.path.join(dirname, 'tsb-import.log'))
 _fh.setFormatter(_formatter)
 _fh.setLevel(logging.INFO)
-logger.addHandler(_fh)
+# buffer file writes, flushing in batches, on anything at WARNING or above, and at exit
+_mh = MemoryHandler(capacity=1024, flushLevel=logging.WARNING, target=_fh)
+_mh.setLevel(logging.INFO)
+logger.addHandler(_mh)
+atexit.register(_mh.close)
 
 logger.info("Importing TSB charges")
+parser = argparse.ArgumentParser(description="Import TSB transactions passed as JSON lines on stdin")
+parser.add_argument('--stream', action='store_true',
+                    help="import each line as it arrives instead of reading the whole batch first")
+args = parser.parse_args()
+
 configFilename = os.path.join(dirname, 'imports.cfg')
 config = configparser.ConfigParser()
 config.read(configFilename)
@@ -68,16 +106,40 @@ bookPath = config['GNUCash']['book_path']
 f6Rent = int(config['GNUCash']['f6_rent'])
 g456Rent = int(config['GNUCash']['g456_rent'])
 auditMinimumAmount = int(config['GNUCash']['audit_minimum_amount'])
-logger.info("Into GnuCash book: {}".format(bookPath))
+# the pound values of those don't change per transaction, so work them out once
+f6Amount = pence_to_decimal(f6Rent)
+g456Amount = pence_to_decimal(g456Rent)
+membershipAmount = pence_to_decimal(auditMinimumAmount)
+logger.info("Into GnuCash book: %s", bookPath)
 
 with open_book(bookPath, readonly=False) as book:
-    tsbAccount = book.accounts(fullname="Assets:Current Assets:TSB Account")
+    # index every account by its full name once, so lookups are a dict hit rather than a tree walk
+    accountsByName = {account.fullname: account for account in book.accounts}
+    tsbAccount = accountsByName["Assets:Current Assets:TSB Account"]
     # grab extra accounts we need
-    g456Account = book.accounts(fullname="Expenses:Bizspace Rent:G4,5,6")
-    electricAccont = book.accounts(fullname="Expenses:Utilities:Electric")
-    donationsMembershipAccount = book.accounts(fullname="Income:Donations:Membership Payments")
+    g456Account = accountsByName["Expenses:Bizspace Rent:G4,5,6"]
+    electricAccont = accountsByName["Expenses:Utilities:Electric"]
+    donationsMembershipAccount = accountsByName["Income:Donations:Membership Payments"]
     gbp = tsbAccount.commodity
 
+    # load every num we have already recorded up front rather than querying the book per line
+    existingNums = {num for (num,) in book.session.query(Transaction.num)}
+
+    # keep the accounts we hold in accountsByName loaded across the checkpoint saves rather than reloading each one after every commit
+    book.session.expire_on_commit = False
+
+    # commit what has been imported so far, if that fails roll it back and tell tsbscrape those rows didn't make it
+    def save_book():
+        if book.is_saved:
+            return
+        try:
+            book.save()
+        except Exception:
+            book.cancel()
+            logger.exception("Failed to save the book, rolled back to the last save")
+            print(json_dumps("Save failed, transactions imported since the last save were not imported"))
+            raise
+
     importCount = 0
     # expect one JSON transaction per line
     # {
@@ -88,95 +150,97 @@ with open_book(bookPath, readonly=False) as book:
     #   amount: 3904,
     #   transferAccount: 'Assets:Current Assets:Stripe'
     # }
-    for line in sys.stdin:
-        transaction = json.loads(line)
-        logger.info("Got Transaction to import: {}".format(json.dumps(transaction)))
-
-        # find the transferAccount
-        try:
-            transferAccount = book.accounts(fullname=transaction['transferAccount'])
-        except KeyError as e:
-            logger.warn("Unable to find Account: {}".format(transaction['transferAccount']))
-            print(json.dumps("Transaction not imported: Unable to find Account: {}".format(hashString)))
-        else:
-            # build hash for transaction to use a an UID
-            hashString = "{}:{};{}".format(transaction['date'], transaction['description'], transaction['amount'])
-            hashHex = hashlib.sha256(hashString.encode()).hexdigest()
-
-            try:
+    if args.stream:
+        # handle each line as soon as it arrives, and make sure our replies go straight back
+        sys.stdout.reconfigure(line_buffering=True)
+        preparedLines = map(prepare_line, (line.rstrip(b"\r\n") for line in sys.stdin.buffer))
+    else:
+        # tsbscrape hands us the whole batch at once, so read it in one go and parse and hash it before touching the book
+        preparedLines = [prepare_line(line) for line in sys.stdin.buffer.read().splitlines()]
+
+    try:
+        for line, transaction, hashString, hashHex in preparedLines:
+            logger.info("Got Transaction to import: %s", line.decode())
+
+            # find the transferAccount
+            transferAccount = accountsByName.get(transaction['transferAccount'])
+            if transferAccount is None:
+                logger.warning("Unable to find Account: %s", transaction['transferAccount'])
+                print(json_dumps("Transaction not imported: Unable to find Account: {}".format(hashString)))
+            else:
                 # see if we have already recorded this transaction
-                book.transactions.get(num=hashHex)
-                logger.info("Skipped already recorded: {} {}".format(hashString, hashHex))
-                print(json.dumps("Skipped already recorded: {}".format(hashString)))
-                continue
-            except KeyError:
-                # we have not yet recorded this txn_ id
-                pass
-
-            # pull out some generic details for this transaction
-            amount = Decimal(transaction['amount'])/100
-            createdAt = isoparse(transaction['date']).astimezone(pytz.timezone("Europe/London"))
-
-            splits = []
-
-            if (transaction['transferAccount'] == 'Expenses:Bizspace Rent:F6' and (-1*transaction['amount']) > (f6Rent+g456Rent)):
-                # pre spilt the rent
-                # prep rent amounts
-                f6Amount = Decimal(f6Rent)/100
-                g456Amount = Decimal(g456Rent)/100
-
-                # calculate electric amount
-                electricAmount = Decimal(transaction['amount'] + f6Rent + g456Rent)/100
-
-                splits=[
-                    Split(account=tsbAccount, value=amount),
-                    Split(account=transferAccount, value=f6Amount), #F6
-                    Split(account=g456Account, value=g456Amount),
-                    Split(account=electricAccont, value=-1*electricAmount)
-                ];
-            elif transaction['transferAccount'] == 'Income:Membership Payments':
-                if transaction['amount'] < auditMinimumAmount:
-                    # payments less than the minimum are counted as donations
+                if hashHex in existingNums:
+                    logger.info("Skipped already recorded: %s %s", hashString, hashHex)
+                    print(json_dumps("Skipped already recorded: {}".format(hashString)))
+                    continue
+
+                # pull out some generic details for this transaction
+                amount = pence_to_decimal(transaction['amount'])
+                createdAt = isoparse(transaction['date']).astimezone(LONDON_TZ)
+
+                splits = []
+
+                if (transaction['transferAccount'] == 'Expenses:Bizspace Rent:F6' and (-1*transaction['amount']) > (f6Rent+g456Rent)):
+                    # pre spilt the rent
+                    # calculate electric amount
+                    electricPence = transaction['amount'] + f6Rent + g456Rent
+
                     splits=[
                         Split(account=tsbAccount, value=amount),
-                        Split(account=donationsMembershipAccount, value=-1*amount),
+                        Split(account=transferAccount, value=f6Amount), #F6
+                        Split(account=g456Account, value=g456Amount),
+                        Split(account=electricAccont, value=pence_to_decimal(-electricPence))
                     ];
-                elif transaction['amount'] == auditMinimumAmount:
+                elif transaction['transferAccount'] == 'Income:Membership Payments':
+                    if transaction['amount'] < auditMinimumAmount:
+                        # payments less than the minimum are counted as donations
+                        splits=[
+                            Split(account=tsbAccount, value=amount),
+                            Split(account=donationsMembershipAccount, value=-1*amount),
+                        ];
+                    elif transaction['amount'] == auditMinimumAmount:
+                        # just the normal splits
+                        splits = [
+                            Split(account=tsbAccount, value=amount),
+                            Split(account=transferAccount, value=-1*amount)
+                        ];
+                    else:
+                        donationsPence = transaction['amount'] - auditMinimumAmount
+
+                        splits=[
+                            Split(account=tsbAccount, value=amount),
+                            Split(account=transferAccount, value=-1*membershipAmount),
+                            Split(account=donationsMembershipAccount, value=pence_to_decimal(-donationsPence)),
+                        ];
+                else:
                     # just the normal splits
                     splits = [
                         Split(account=tsbAccount, value=amount),
                         Split(account=transferAccount, value=-1*amount)
                     ];
-                else:
-                    membershipAmount = Decimal(auditMinimumAmount)/100
-                    donationsAmount = Decimal(transaction['amount'] - auditMinimumAmount)/100
-
-                    splits=[
-                        Split(account=tsbAccount, value=amount),
-                        Split(account=transferAccount, value=-1*membershipAmount),
-                        Split(account=donationsMembershipAccount, value=-1*donationsAmount),
-                    ];
-            else:
-                # just the normal splits
-                splits = [
-                    Split(account=tsbAccount, value=amount),
-                    Split(account=transferAccount, value=-1*amount)
-                ];
-
-            # now we have the splits we can create the trasnaction
-            Transaction(currency=gbp,
-                        enter_date=createdAt,
-                        post_date=createdAt.date(),
-                        num=hashHex,
-                        description=transaction['description'],
-                        splits=splits
-                        )
-
-            # save the book
-            if not book.is_saved:
-                book.save()
-
-            importCount += 1
-            logger.info("Imported, Total count: {}".format(importCount))
-            print(json.dumps("Imported, Total count: {}".format(importCount)))
 
+                # now we have the splits we can create the trasnaction
+                Transaction(currency=gbp,
+                            enter_date=createdAt,
+                            post_date=createdAt.date(),
+                            num=hashHex,
+                            description=transaction['description'],
+                            splits=splits
+                            )
+                existingNums.add(hashHex)
+
+                importCount += 1
+                logger.info("Imported, Total count: %s", importCount)
+                print(json_dumps("Imported, Total count: {}".format(importCount)))
+
+                # checkpoint long batches so a failure late on doesn't lose everything before it
+                if importCount % 100 == 0:
+                    save_book()
+    except Exception:
+        # keep what was imported before the failing line,
+        # if it was a save that failed it has already been rolled back so there is nothing left to save
+        save_book()
+        raise
+
+    # save the book once everything has been imported
+    save_book()